@@ -6,76 +6,491 @@
 功能: 雙網頁架構的影片播放系統，支援跨設備控制
 """
 
+# eventlet 必須在其他模組載入前完成 monkey patch
+import eventlet
+eventlet.monkey_patch()
+from eventlet import tpool
+
 import os
-import json
 import re
-from flask import Flask, render_template, jsonify, send_from_directory, request
+from flask import Flask, render_template, jsonify, send_from_directory, request, Response, abort
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import threading
 import time
+import mimetypes
+import hashlib
+import uuid
+import orjson
 from pathlib import Path
+from urllib.parse import quote
+from werkzeug.security import safe_join
+
+# Redis 位址（如 'redis://redis:6379/0'）。設定後 Socket.IO 事件經由 Redis pub/sub 轉發，
+# 房間與客戶端狀態也改存於 Redis，可同時執行多個伺服器程序
+REDIS_URL = None
+
+class OrjsonProvider(JSONProvider):
+    """以 orjson 取代標準庫 json 的 Flask JSON provider（保留 jsonify 的排序鍵行為）"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = '20252025202520252025202520252025'
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 使用 eventlet 事件迴圈，每個 WebSocket 連線只佔用一個 greenlet 而非一條 OS 執行緒
+# 封包以 MsgPack 二進位格式傳送（前端需使用 socket.io.msgpack.min.js）
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*",
+                    serializer='msgpack', http_compression=True,
+                    message_queue=REDIS_URL)
 
 # 配置
 DATA_DIR = './data'
 PORT = 5000
+# 置於 nginx 之後時，設為 internal location 前綴（如 '/_protected_data/'），
+# 影片改由 nginx 以 sendfile() 直接傳送，不經 Python 複製
+X_ACCEL_REDIRECT_PREFIX = None
+LOBBY_ROOM = '__lobby__'  # 房間管理頁面所在的 Socket.IO 房間
+ROOMS_UPDATE_INTERVAL = 0.25  # 房間列表更新的合併間隔（秒）
+TIME_UPDATE_INTERVAL = 1.0  # 播放時間寫回房間狀態的間隔（秒）
+SCAN_WORKERS = 16  # 掃描影片庫時的平行目錄數
+ROOM_IDLE_TIMEOUT = 1800  # 房間無客戶端超過此秒數後清除
+ROOM_GC_INTERVAL = 60  # 清理閒置房間的檢查間隔（秒）
+PROCESS_HEARTBEAT_INTERVAL = 10  # Redis 模式下程序心跳的更新間隔（秒）
+PROCESS_TTL = 30  # 程序心跳逾時秒數，逾時後其客戶端記錄視為失效
+
+# 客戶端類型（以整數儲存，避免在加入/離開時比對字串）
+PLAYER, CONTROLLER, OTHER = 0, 1, 2
+CLIENT_TYPES = {'player': PLAYER, 'controller': CONTROLLER}
+
+# 推送給客戶端的房間狀態欄位
+PUBLIC_STATE_KEYS = ('current_movie', 'current_episode', 'is_playing', 'current_time', 'volume')
+
+def _room_defaults():
+    """新房間的欄位預設值（不含客戶端集合）"""
+    now = time.time()
+    return {
+        'current_movie': None,
+        'current_episode': None,
+        'is_playing': False,
+        'current_time': 0,
+        'volume': 1.0,
+        'created_at': now,
+        'emptied_at': now,  # 房間變為無客戶端的時間，有客戶端時為 None
+        'time_reset_at': 0  # 最近一次 seek/換集的時間，早於此刻的播放器回報一律捨棄
+    }
+
+class MemoryRoomStore:
+    """房間與客戶端狀態保存在程序記憶體中（單一程序部署）"""
+    
+    def __init__(self):
+        self.rooms = {}  # 房間狀態字典
+        self.clients = {}  # 客戶端連接信息 {sid: (room_id, client_type, joined_at)}
+        self._version = 0
+        self._boot_id = format(time.time_ns(), 'x')  # 加上啟動識別碼避免重啟後 ETag 重複
+    
+    def get_or_create(self, room_id):
+        """回傳 (房間狀態, 是否為新建房間)"""
+        room_state = self.rooms.get(room_id)
+        if room_state is not None:
+            return room_state, False
+        room_state = _room_defaults()
+        room_state['players'] = set()
+        room_state['controllers'] = set()
+        self.rooms[room_id] = room_state
+        return room_state, True
+    
+    def exists(self, room_id):
+        return room_id in self.rooms
+    
+    def save(self, room_id, fields):
+        """寫入房間欄位（房間不存在時忽略）"""
+        room_state = self.rooms.get(room_id)
+        if room_state is not None:
+            room_state.update(fields)
+    
+    def save_time(self, room_id, current_time, reported_at):
+        """寫入播放器回報的時間；房間不存在或回報早於 time_reset_at 時忽略"""
+        room_state = self.rooms.get(room_id)
+        if room_state is not None and reported_at > room_state['time_reset_at']:
+            room_state['current_time'] = current_time
+    
+    def add_client(self, room_id, client_id, client_type):
+        room_state = self.rooms[room_id]
+        if client_type == PLAYER:
+            room_state['players'].add(client_id)
+            room_state['emptied_at'] = None
+        elif client_type == CONTROLLER:
+            room_state['controllers'].add(client_id)
+            room_state['emptied_at'] = None
+        
+        self.clients[client_id] = (room_id, client_type, time.time())
+    
+    def remove_client(self, client_id):
+        if client_id not in self.clients:
+            return
+        room_id, client_type, _ = self.clients.pop(client_id)
+        
+        room_state = self.rooms.get(room_id)
+        if room_state is None:
+            return
+        if client_type == PLAYER:
+            room_state['players'].discard(client_id)
+        elif client_type == CONTROLLER:
+            room_state['controllers'].discard(client_id)
+        
+        # 如果房間沒有客戶端了，記錄時間，交由 _room_gc 清理
+        if not room_state['players'] and not room_state['controllers']:
+            # 保留房間狀態 30 分鐘，以防客戶端重新連接
+            if room_state['emptied_at'] is None:
+                room_state['emptied_at'] = time.time()
+    
+    def items(self):
+        """所有房間的 (room_id, 房間狀態) 快照"""
+        return list(self.rooms.items())
+    
+    def delete_if_idle(self, room_id, now, timeout):
+        """房間仍為空且閒置超過 timeout 秒時刪除，回傳是否已刪除"""
+        room_state = self.rooms.get(room_id)
+        if room_state is None or room_state['players'] or room_state['controllers']:
+            return False
+        emptied_at = room_state['emptied_at']
+        if emptied_at is None or now - emptied_at <= timeout:
+            return False
+        del self.rooms[room_id]
+        return True
+    
+    def client_count(self):
+        return len(self.clients)
+    
+    def bump_version(self):
+        self._version += 1
+    
+    def version(self):
+        return f'{self._boot_id}-{self._version}'
+
+class RedisRoomStore:
+    """房間與客戶端狀態保存在 Redis，供多個伺服器程序共用
+    
+    - {prefix}rooms：房間 ID 集合
+    - {prefix}room:<id>：房間欄位（hash，值以 JSON 編碼）
+    - {prefix}room:<id>:players / :controllers：客戶端 sid 集合
+    - {prefix}clients：{sid: [room_id, client_type, joined_at, process_id]}（hash）
+    - {prefix}rooms_version：房間列表版本號
+    - {prefix}processes：曾登記的伺服器程序 ID 集合
+    - {prefix}process:<id>：程序心跳（附 TTL，程序異常結束後自動過期）
+    - {prefix}process:<id>:clients：該程序連線中的客戶端 sid 集合
+    """
+    
+    PREFIX = 'movie_server:'
+    
+    # KEYS: rooms, room, players, controllers；ARGV: room_id, now, timeout
+    # 在 Redis 端一次完成檢查與刪除，避免檢查後才有客戶端加入
+    _DELETE_IF_IDLE = """
+    if redis.call('SCARD', KEYS[3]) > 0 or redis.call('SCARD', KEYS[4]) > 0 then
+        return 0
+    end
+    local emptied_at = tonumber(redis.call('HGET', KEYS[2], 'emptied_at'))
+    if not emptied_at or tonumber(ARGV[2]) - emptied_at <= tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call('SREM', KEYS[1], ARGV[1])
+    redis.call('DEL', KEYS[2], KEYS[3], KEYS[4])
+    return 1
+    """
+    
+    # KEYS: rooms, room；ARGV: room_id, current_time（JSON）, reported_at
+    _SAVE_TIME = """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+        return 0
+    end
+    local reset_at = tonumber(redis.call('HGET', KEYS[2], 'time_reset_at')) or 0
+    if tonumber(ARGV[3]) <= reset_at then
+        return 0
+    end
+    redis.call('HSET', KEYS[2], 'current_time', ARGV[2])
+    return 1
+    """
+    
+    def __init__(self, client):
+        self._redis = client
+        self._rooms_key = self.PREFIX + 'rooms'
+        self._clients_key = self.PREFIX + 'clients'
+        self._version_key = self.PREFIX + 'rooms_version'
+        self._processes_key = self.PREFIX + 'processes'
+        self.process_id = uuid.uuid4().hex
+        self._delete_if_idle = client.register_script(self._DELETE_IF_IDLE)
+        self._save_time = client.register_script(self._SAVE_TIME)
+    
+    def _room_key(self, room_id):
+        return f'{self.PREFIX}room:{room_id}'
+    
+    def _process_key(self, process_id):
+        return f'{self.PREFIX}process:{process_id}'
+    
+    @staticmethod
+    def _decode(fields, players, controllers):
+        room_state = {key: orjson.loads(value) for key, value in fields.items()}
+        room_state['players'] = players
+        room_state['controllers'] = controllers
+        return room_state
+    
+    def _ensure_room(self, pipe, room_id):
+        """在 pipeline 中加入「房間不存在時以預設值建立」的指令"""
+        key = self._room_key(room_id)
+        pipe.sadd(self._rooms_key, room_id)
+        for field, value in _room_defaults().items():
+            pipe.hsetnx(key, field, orjson.dumps(value))
+        return key
+    
+    def get_or_create(self, room_id):
+        """回傳 (房間狀態, 是否為新建房間)；多個程序同時建立時只有一方回報新建"""
+        pipe = self._redis.pipeline()
+        key = self._ensure_room(pipe, room_id)
+        pipe.hgetall(key)
+        pipe.smembers(key + ':players')
+        pipe.smembers(key + ':controllers')
+        results = pipe.execute()
+        return self._decode(*results[-3:]), results[0] == 1
+    
+    def exists(self, room_id):
+        return bool(self._redis.sismember(self._rooms_key, room_id))
+    
+    def save(self, room_id, fields):
+        """寫入房間欄位"""
+        self._redis.hset(self._room_key(room_id), mapping={
+            field: orjson.dumps(value) for field, value in fields.items()
+        })
+    
+    def save_time(self, room_id, current_time, reported_at):
+        """寫入播放器回報的時間；房間不存在或回報早於 time_reset_at 時忽略"""
+        self._save_time(keys=[self._rooms_key, self._room_key(room_id)],
+                        args=[room_id, orjson.dumps(current_time), reported_at])
+    
+    def add_client(self, room_id, client_id, client_type):
+        pipe = self._redis.pipeline()
+        # 房間可能在 get_or_create 之後被其他程序的 _room_gc 刪除，於同一交易中重新確保存在
+        key = self._ensure_room(pipe, room_id)
+        if client_type == PLAYER:
+            pipe.sadd(key + ':players', client_id)
+            pipe.hset(key, 'emptied_at', orjson.dumps(None))
+        elif client_type == CONTROLLER:
+            pipe.sadd(key + ':controllers', client_id)
+            pipe.hset(key, 'emptied_at', orjson.dumps(None))
+        pipe.hset(self._clients_key, client_id,
+                  orjson.dumps([room_id, client_type, time.time(), self.process_id]))
+        pipe.sadd(self._process_key(self.process_id) + ':clients', client_id)
+        pipe.execute()
+    
+    def remove_client(self, client_id):
+        record = self._redis.hget(self._clients_key, client_id)
+        if record is None:
+            return
+        room_id, _, _, process_id = orjson.loads(record)
+        key = self._room_key(room_id)
+        
+        pipe = self._redis.pipeline()
+        pipe.hdel(self._clients_key, client_id)
+        pipe.srem(self._process_key(process_id) + ':clients', client_id)
+        pipe.srem(key + ':players', client_id)
+        pipe.srem(key + ':controllers', client_id)
+        pipe.sismember(self._rooms_key, room_id)
+        pipe.scard(key + ':players')
+        pipe.scard(key + ':controllers')
+        pipe.hget(key, 'emptied_at')
+        exists, players_count, controllers_count, emptied_at = pipe.execute()[4:]
+        
+        # 如果房間沒有客戶端了，記錄時間，交由 _room_gc 清理
+        if exists and not players_count and not controllers_count:
+            if emptied_at is None or orjson.loads(emptied_at) is None:
+                self._redis.hset(key, 'emptied_at', orjson.dumps(time.time()))
+    
+    def items(self):
+        """所有房間的 (room_id, 房間狀態) 快照"""
+        room_ids = list(self._redis.smembers(self._rooms_key))
+        pipe = self._redis.pipeline()
+        for room_id in room_ids:
+            key = self._room_key(room_id)
+            pipe.hgetall(key)
+            pipe.smembers(key + ':players')
+            pipe.smembers(key + ':controllers')
+        results = pipe.execute()
+        
+        rooms = []
+        for index, room_id in enumerate(room_ids):
+            fields, players, controllers = results[index * 3:index * 3 + 3]
+            if fields:  # 略過其他程序剛刪除的房間
+                rooms.append((room_id, self._decode(fields, players, controllers)))
+        return rooms
+    
+    def delete_if_idle(self, room_id, now, timeout):
+        """房間仍為空且閒置超過 timeout 秒時刪除，回傳是否已刪除"""
+        key = self._room_key(room_id)
+        keys = [self._rooms_key, key, key + ':players', key + ':controllers']
+        return self._delete_if_idle(keys=keys, args=[room_id, now, timeout]) == 1
+    
+    def client_count(self):
+        return self._redis.hlen(self._clients_key)
+    
+    def bump_version(self):
+        self._redis.incr(self._version_key)
+    
+    def version(self):
+        return f'redis-{self._redis.get(self._version_key) or 0}'
+    
+    def heartbeat(self):
+        """登記本程序並更新心跳"""
+        pipe = self._redis.pipeline()
+        pipe.sadd(self._processes_key, self.process_id)
+        pipe.set(self._process_key(self.process_id), 1, ex=PROCESS_TTL)
+        pipe.execute()
+    
+    def reap_dead_processes(self):
+        """移除心跳已過期的程序留下的客戶端記錄，回傳是否有移除"""
+        removed = False
+        for process_id in self._redis.smembers(self._processes_key):
+            if process_id == self.process_id:
+                continue
+            process_key = self._process_key(process_id)
+            if self._redis.exists(process_key):
+                continue
+            for client_id in self._redis.smembers(process_key + ':clients'):
+                self.remove_client(client_id)
+                removed = True
+            pipe = self._redis.pipeline()
+            pipe.delete(process_key + ':clients')
+            pipe.srem(self._processes_key, process_id)
+            pipe.execute()
+        return removed
+
+# 全域狀態 - 支援多房間；設定 REDIS_URL 時改存於 Redis，供多個程序共用
+if REDIS_URL:
+    import redis
+    room_store = RedisRoomStore(redis.Redis.from_url(REDIS_URL, decode_responses=True))
+else:
+    room_store = MemoryRoomStore()
+
+# 影片庫快取 - 以 DATA_DIR 及各子目錄的 mtime 判斷是否需要重新掃描
+_scan_cache = {'mtime': None, 'subdirs': {}, 'result': None, 'json_bytes': None, 'etag': None}
+_scan_lock = threading.Lock()
 
-# 全域狀態 - 支援多房間
-rooms_state = {}  # 房間狀態字典
-connected_clients = {}  # 客戶端連接信息
+# 房間列表更新 - 標記後由背景任務合併廣播
+_rooms_dirty = False
+# 播放器回報的最新時間 {room_id: time}，由背景任務每秒寫回房間狀態
+_pending_times = {}
+_background_started = False
 
 def get_room_state(room_id):
     """獲取或創建房間狀態"""
-    if room_id not in rooms_state:
-        rooms_state[room_id] = {
-            'current_movie': None,
-            'current_episode': None,
-            'is_playing': False,
-            'current_time': 0,
-            'volume': 1.0,
-            'players': [],
-            'controllers': [],
-            'created_at': time.time()
-        }
-    return rooms_state[room_id]
+    room_state, created = room_store.get_or_create(room_id)
+    if created:
+        notify_rooms_update()
+    return room_state
 
-def add_client_to_room(room_id, client_id, client_type):
-    """添加客戶端到房間"""
+def update_room_state(room_id, **fields):
+    """更新房間欄位並寫回儲存區，回傳更新後的房間狀態"""
     room_state = get_room_state(room_id)
-    if client_type == 'player' and client_id not in room_state['players']:
-        room_state['players'].append(client_id)
-    elif client_type == 'controller' and client_id not in room_state['controllers']:
-        room_state['controllers'].append(client_id)
-    
-    connected_clients[client_id] = {
-        'room': room_id,
-        'type': client_type,
-        'joined_at': time.time()
-    }
+    room_store.save(room_id, fields)
+    # Redis 模式下 room_state 為讀取時的副本，需同步新值
+    room_state.update(fields)
+    return room_state
+
+def _public_state(room_state):
+    """房間狀態中需要推送給客戶端的欄位（不含客戶端列表）"""
+    return {key: room_state[key] for key in PUBLIC_STATE_KEYS}
+
+def _latest_time(room_id, room_state):
+    """房間最新的播放位置（含尚未寫回的播放器回報）"""
+    pending = _pending_times.get(room_id)
+    if pending is not None and pending[1] > room_state['time_reset_at']:
+        return pending[0]
+    return room_state['current_time']
+
+def add_client_to_room(room_id, client_id, client_type):
+    """添加客戶端到房間（client_type 為 PLAYER/CONTROLLER/OTHER）"""
+    get_room_state(room_id)
+    room_store.add_client(room_id, client_id, client_type)
 
 def remove_client_from_room(client_id):
     """從房間移除客戶端"""
-    if client_id in connected_clients:
-        client_info = connected_clients[client_id]
-        room_id = client_info['room']
-        client_type = client_info['type']
-        
-        if room_id in rooms_state:
-            room_state = rooms_state[room_id]
-            if client_type == 'player' and client_id in room_state['players']:
-                room_state['players'].remove(client_id)
-            elif client_type == 'controller' and client_id in room_state['controllers']:
-                room_state['controllers'].remove(client_id)
-            
-            # 如果房間沒有客戶端了，清理房間（可選）
-            if not room_state['players'] and not room_state['controllers']:
-                # 保留房間狀態 30 分鐘，以防客戶端重新連接
-                pass
-        
-        del connected_clients[client_id]
+    room_store.remove_client(client_id)
+
+def notify_rooms_update():
+    """標記房間列表已變動，由背景任務合併後只廣播給大廳"""
+    global _rooms_dirty
+    _rooms_dirty = True
+    room_store.bump_version()
+
+def _flush_rooms_update():
+    """定期將累積的房間列表變動合併為一次廣播"""
+    global _rooms_dirty
+    while True:
+        socketio.sleep(ROOMS_UPDATE_INTERVAL)
+        if _rooms_dirty:
+            _rooms_dirty = False
+            socketio.emit('rooms_update', room=LOBBY_ROOM)
+
+def _flush_time_updates():
+    """每秒將播放器回報的時間寫回房間狀態
+    
+    寫回期間可能有 seek/換集（本程序或其他程序），由 store 比對 time_reset_at，
+    捨棄早於該時刻的回報，避免舊位置覆蓋新位置。
+    """
+    global _pending_times
+    while True:
+        socketio.sleep(TIME_UPDATE_INTERVAL)
+        if not _pending_times:
+            continue
+        pending, _pending_times = _pending_times, {}
+        for room_id, (current_time, reported_at) in pending.items():
+            room_store.save_time(room_id, current_time, reported_at)
+
+def _room_gc():
+    """定期清除閒置超過 ROOM_IDLE_TIMEOUT 的空房間"""
+    while True:
+        socketio.sleep(ROOM_GC_INTERVAL)
+        now = time.time()
+        removed = False
+        # 以快照迭代，避免與事件處理同時修改房間列表
+        for room_id, room_state in room_store.items():
+            emptied_at = room_state['emptied_at']
+            if emptied_at is None or now - emptied_at <= ROOM_IDLE_TIMEOUT:
+                continue
+            # 快照之後可能已有客戶端加入，由 store 重新檢查並原子地刪除
+            if room_store.delete_if_idle(room_id, now, ROOM_IDLE_TIMEOUT):
+                _pending_times.pop(room_id, None)
+                removed = True
+        if removed:
+            notify_rooms_update()
+
+def _process_heartbeat():
+    """Redis 模式：定期更新本程序心跳，並清除已結束程序留下的客戶端"""
+    while True:
+        socketio.sleep(PROCESS_HEARTBEAT_INTERVAL)
+        room_store.heartbeat()
+        if room_store.reap_dead_processes():
+            notify_rooms_update()
+
+def _start_background_tasks():
+    """啟動背景任務（只執行一次）"""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    socketio.start_background_task(_flush_rooms_update)
+    socketio.start_background_task(_flush_time_updates)
+    socketio.start_background_task(_room_gc)
+    if isinstance(room_store, RedisRoomStore):
+        # 先同步登記心跳，避免本程序的客戶端在首次心跳前被其他程序清除
+        room_store.heartbeat()
+        socketio.start_background_task(_process_heartbeat)
+
+# 自然排序用的數字樣式（模組載入時預先編譯）
+_NUM_RE = re.compile(r'(\d+)')
 
 def natural_sort_key(episode_name):
     """
@@ -84,88 +499,169 @@ def natural_sort_key(episode_name):
     - 中文數字：第1集, 第2集...
     - 混合格式：電影名1, 電影名2...
     """
-    # 提取數字部分進行排序
-    numbers = re.findall(r'\d+', episode_name)
-    if numbers:
-        # 使用第一個找到的數字作為排序依據
-        main_number = int(numbers[0])
-        return (main_number, episode_name)
+    # 使用第一個找到的數字作為排序依據
+    match = _NUM_RE.search(episode_name)
+    if match:
+        return (int(match.group(1)), episode_name)
     else:
         # 沒有數字的情況，按字母順序排序
         return (float('inf'), episode_name)
 
+def _scan_cache_valid(root_mtime):
+    """檢查快取是否仍然有效（根目錄與各子目錄 mtime 皆未變動）"""
+    if _scan_cache['result'] is None or _scan_cache['mtime'] != root_mtime:
+        return False
+    for movie_dir, mtime in _scan_cache['subdirs'].items():
+        try:
+            if os.stat(os.path.join(DATA_DIR, movie_dir)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
 def scan_movies():
-    """掃描影片目錄，建立影片庫"""
-    movies = {}
-    
+    """掃描影片目錄，建立影片庫（目錄未變動時直接回傳快取）"""
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
+        return {}
+    
+    with _scan_lock:
+        root_mtime = os.stat(DATA_DIR).st_mtime_ns
+        if _scan_cache_valid(root_mtime):
+            return _scan_cache['result']
+        
+        movies, subdirs = _scan_movies_uncached()
+        json_bytes = _encode_movies(movies)
+        _scan_cache.update({
+            'mtime': root_mtime,
+            'subdirs': subdirs,
+            'result': movies,
+            'json_bytes': json_bytes,
+            'etag': _make_etag(json_bytes)
+        })
         return movies
+
+def _encode_movies(movies):
+    """將影片庫序列化為 JSON bytes（與 jsonify 相同採用排序鍵）"""
+    return orjson.dumps(movies, option=orjson.OPT_SORT_KEYS)
+
+def _make_etag(json_bytes):
+    """以內容雜湊產生 ETag"""
+    return hashlib.sha1(json_bytes).hexdigest()
+
+def _get_cached_json():
+    """取得影片庫的 (JSON bytes, ETag)，快取有效時不重新序列化"""
+    movies = scan_movies()
+    with _scan_lock:
+        if _scan_cache['result'] is movies:
+            return _scan_cache['json_bytes'], _scan_cache['etag']
+    json_bytes = _encode_movies(movies)
+    return json_bytes, _make_etag(json_bytes)
+
+def _not_modified(etag):
+    """客戶端快取的 ETag 仍有效時回傳 304 回應，否則回傳 None"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def _list_media_files(path):
+    """單次 scandir 取得目錄中的 mp4 檔名列表、jpg 檔名集合與子目錄 DirEntry 列表"""
+    mp4s = []
+    jpgs = set()
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # DirEntry 的 is_dir()/is_file() 使用 getdents 回傳的 d_type，不需額外 stat
+            if entry.is_dir():
+                subdirs.append(entry)
+            elif not entry.is_file():
+                continue
+            elif entry.name.endswith('.mp4'):
+                mp4s.append(entry.name)
+            elif entry.name.endswith('.jpg'):
+                jpgs.add(entry.name)
+    return mp4s, jpgs, subdirs
+
+def _scan_one(entry):
+    """掃描單一電影目錄（DirEntry），回傳 (目錄名, 電影資訊, mtime)"""
+    movie_dir = entry.name
+    mtime = entry.stat().st_mtime_ns
+    
+    # 電影資訊
+    movie_info = {
+        'name': movie_dir,
+        'thumbnail': None,
+        'episodes': []
+    }
+    
+    mp4s, jpgs, _ = _list_media_files(entry.path)
+    
+    # 檢查電影主縮圖
+    if '縮圖.jpg' in jpgs:
+        movie_info['thumbnail'] = f'data/{movie_dir}/縮圖.jpg'
+    
+    # 掃描集數
+    for file in mp4s:
+        episode_name = file[:-4]  # 移除 .mp4 副檔名
+        episode_info = {
+            'name': episode_name,
+            'file': f'data/{movie_dir}/{file}',
+            'thumbnail': None,
+            'display_name': episode_name  # 顯示名稱
+        }
+        
+        # 為純數字檔名創建更友好的顯示名稱
+        if episode_name.isdigit():
+            episode_info['display_name'] = f'第 {episode_name} 集'
+        
+        # 檢查集數縮圖
+        if f'{episode_name}.jpg' in jpgs:
+            episode_info['thumbnail'] = f'data/{movie_dir}/{episode_name}.jpg'
+        
+        movie_info['episodes'].append(episode_info)
+    
+    # 使用智能排序
+    movie_info['episodes'].sort(key=lambda x: natural_sort_key(x['name']))
+    return movie_dir, movie_info, mtime
+
+def _scan_movies_uncached():
+    """實際掃描影片目錄，回傳影片庫及各子目錄的 mtime"""
+    movies = {}
+    subdirs = {}
+    
+    # 單次 scandir 同時取得電影目錄與根目錄下的散亂影片
+    root_mp4s, root_jpgs, movie_entries = _list_media_files(DATA_DIR)
     
-    # 掃描目錄結構
-    for movie_dir in os.listdir(DATA_DIR):
-        movie_path = os.path.join(DATA_DIR, movie_dir)
-        if os.path.isdir(movie_path):
-            # 電影資訊
-            movie_info = {
-                'name': movie_dir,
-                'thumbnail': None,
-                'episodes': []
-            }
-            
-            # 檢查電影主縮圖
-            thumbnail_path = os.path.join(movie_path, '縮圖.jpg')
-            if os.path.exists(thumbnail_path):
-                movie_info['thumbnail'] = f'data/{movie_dir}/縮圖.jpg'
-            
-            # 掃描集數
-            for file in os.listdir(movie_path):
-                if file.endswith('.mp4'):
-                    episode_name = file[:-4]  # 移除 .mp4 副檔名
-                    episode_info = {
-                        'name': episode_name,
-                        'file': f'data/{movie_dir}/{file}',
-                        'thumbnail': None,
-                        'display_name': episode_name  # 顯示名稱
-                    }
-                    
-                    # 為純數字檔名創建更友好的顯示名稱
-                    if episode_name.isdigit():
-                        episode_info['display_name'] = f'第 {episode_name} 集'
-                    
-                    # 檢查集數縮圖
-                    episode_thumbnail = os.path.join(movie_path, f'{episode_name}.jpg')
-                    if os.path.exists(episode_thumbnail):
-                        episode_info['thumbnail'] = f'data/{movie_dir}/{episode_name}.jpg'
-                    
-                    movie_info['episodes'].append(episode_info)
-            
-            # 使用智能排序
-            movie_info['episodes'].sort(key=lambda x: natural_sort_key(x['name']))
-            movies[movie_dir] = movie_info
+    # 各電影目錄互不相依，交由 eventlet 的原生執行緒池平行掃描
+    # （monkey patch 後的 threading 為 greenlet，阻塞的檔案系統呼叫無法並行）
+    pool = eventlet.GreenPool(SCAN_WORKERS)
+    for movie_dir, movie_info, mtime in pool.imap(
+            lambda entry: tpool.execute(_scan_one, entry), movie_entries):
+        subdirs[movie_dir] = mtime
+        movies[movie_dir] = movie_info
     
     # 處理根目錄下的散亂影片文件（如：1.mp4, 2.mp4）
     root_videos = []
-    for file in os.listdir(DATA_DIR):
-        if file.endswith('.mp4') and os.path.isfile(os.path.join(DATA_DIR, file)):
-            episode_name = file[:-4]
-            episode_info = {
-                'name': episode_name,
-                'file': f'data/{file}',
-                'thumbnail': None,
-                'display_name': episode_name
-            }
-            
-            # 為純數字檔名創建更友好的顯示名稱
-            if episode_name.isdigit():
-                episode_info['display_name'] = f'第 {episode_name} 集'
-            
-            # 檢查縮圖
-            episode_thumbnail = os.path.join(DATA_DIR, f'{episode_name}.jpg')
-            if os.path.exists(episode_thumbnail):
-                episode_info['thumbnail'] = f'data/{episode_name}.jpg'
-            
-            root_videos.append(episode_info)
+    for file in root_mp4s:
+        episode_name = file[:-4]
+        episode_info = {
+            'name': episode_name,
+            'file': f'data/{file}',
+            'thumbnail': None,
+            'display_name': episode_name
+        }
+        
+        # 為純數字檔名創建更友好的顯示名稱
+        if episode_name.isdigit():
+            episode_info['display_name'] = f'第 {episode_name} 集'
+        
+        # 檢查縮圖
+        if f'{episode_name}.jpg' in root_jpgs:
+            episode_info['thumbnail'] = f'data/{episode_name}.jpg'
+        
+        root_videos.append(episode_info)
     
     # 如果有根目錄影片，創建一個特殊的"未分類影片"分類
     if root_videos:
@@ -176,7 +672,7 @@ def scan_movies():
             'episodes': root_videos
         }
     
-    return movies
+    return movies, subdirs
 
 # 路由設定
 @app.route('/')
@@ -191,15 +687,19 @@ def player():
 
 @app.route('/control')
 def control():
-    """控制台頁面（網頁B）"""
-    movies = scan_movies()
-    return render_template('control.html', movies=movies)
+    """控制台頁面（網頁B）- 影片庫由前端透過 /api/movies 載入"""
+    return render_template('control.html')
 
 @app.route('/api/movies')
 def api_movies():
     """獲取影片列表 API"""
-    movies = scan_movies()
-    return jsonify(movies)
+    json_bytes, etag = _get_cached_json()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+    response = Response(json_bytes, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 @app.route('/rooms')
 def rooms_page():
@@ -214,14 +714,18 @@ def player_with_room(room_id):
 @app.route('/control/<room_id>')
 def control_with_room(room_id):
     """指定房間的控制台頁面"""
-    movies = scan_movies()
-    return render_template('control.html', movies=movies, room_id=room_id)
+    return render_template('control.html', room_id=room_id)
 
 @app.route('/api/rooms')
 def api_rooms():
     """獲取所有房間信息"""
+    etag = room_store.version()
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+    
     room_list = []
-    for room_id, state in rooms_state.items():
+    for room_id, state in room_store.items():
         room_info = {
             'id': room_id,
             'current_movie': state['current_movie'],
@@ -233,34 +737,54 @@ def api_rooms():
         }
         room_list.append(room_info)
     
-    return jsonify({
+    response = jsonify({
         'rooms': room_list,
-        'total_clients': len(connected_clients)
+        'total_clients': room_store.client_count()
     })
+    response.set_etag(etag)
+    return response
 
 @app.route('/api/state/<room_id>')
 def api_room_state(room_id):
     """獲取指定房間的狀態"""
     room_state = get_room_state(room_id)
-    return jsonify(room_state)
+    # 只回傳公開欄位（不含 emptied_at 等內部記錄）；set 無法直接序列化，回傳時轉為 list
+    return jsonify(dict(_public_state(room_state),
+                        created_at=room_state['created_at'],
+                        players=list(room_state['players']),
+                        controllers=list(room_state['controllers'])))
 
 @app.route('/data/<path:filename>')
 def serve_media(filename):
-    """提供影片和縮圖檔案"""
-    return send_from_directory(DATA_DIR, filename)
+    """提供影片和縮圖檔案（支援 Range 請求，可交由 nginx 傳送）"""
+    if X_ACCEL_REDIRECT_PREFIX:
+        file_path = safe_join(DATA_DIR, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return Response(mimetype=mimetype, headers={
+            'X-Accel-Redirect': X_ACCEL_REDIRECT_PREFIX + quote(filename)
+        })
+    return send_from_directory(DATA_DIR, filename, conditional=True)
 
 # WebSocket 事件處理
 # WebSocket 事件處理
 @socketio.on('connect')
 def handle_connect():
+    _start_background_tasks()
     print(f'客戶端已連接: {request.sid}')
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print(f'客戶端已斷線: {request.sid}')
     remove_client_from_room(request.sid)
-    # 廣播房間列表更新
-    socketio.emit('rooms_update')
+    # 通知大廳房間列表更新
+    notify_rooms_update()
+
+@socketio.on('join_lobby')
+def handle_join_lobby():
+    """房間管理頁面加入大廳，接收房間列表更新"""
+    join_room(LOBBY_ROOM)
 
 @socketio.on('join_room')
 def handle_join_room(data):
@@ -268,14 +792,16 @@ def handle_join_room(data):
     client_type = data.get('type', 'unknown')  # 'player' 或 'controller'
     
     join_room(room_id)
-    add_client_to_room(room_id, request.sid, client_type)
+    # type 來自客戶端，非字串（如 list）時不可作為字典鍵
+    client_kind = CLIENT_TYPES.get(client_type, OTHER) if isinstance(client_type, str) else OTHER
+    add_client_to_room(room_id, request.sid, client_kind)
     
     room_state = get_room_state(room_id)
-    emit('state_update', room_state)
+    emit('state_update', _public_state(room_state))
     emit('room_joined', {'room': room_id, 'type': client_type})
     
-    # 廣播房間列表更新給所有客戶端
-    socketio.emit('rooms_update')
+    # 通知大廳房間列表更新
+    notify_rooms_update()
     
     print(f'客戶端 {request.sid} 以 {client_type} 身份加入房間: {room_id}')
 
@@ -285,8 +811,8 @@ def handle_leave_room(data):
     leave_room(room_id)
     remove_client_from_room(request.sid)
     
-    # 廣播房間列表更新
-    socketio.emit('rooms_update')
+    # 通知大廳房間列表更新
+    notify_rooms_update()
     
     print(f'客戶端 {request.sid} 離開房間: {room_id}')
 
@@ -297,13 +823,14 @@ def handle_play_episode(data):
     movie = data.get('movie')
     episode = data.get('episode')
     
-    room_state = get_room_state(room_id)
-    room_state.update({
-        'current_movie': movie,
-        'current_episode': episode,
-        'is_playing': True,
-        'current_time': 0
-    })
+    room_state = update_room_state(
+        room_id,
+        current_movie=movie,
+        current_episode=episode,
+        is_playing=True,
+        current_time=0,
+        time_reset_at=time.time()  # 上一集尚未寫回的播放時間不再覆蓋歸零的位置
+    )
     
     # 只廣播給該房間的客戶端
     socketio.emit('play_episode', {
@@ -312,8 +839,8 @@ def handle_play_episode(data):
         'file_path': data.get('file_path')
     }, room=room_id)
     
-    socketio.emit('state_update', room_state, room=room_id)
-    socketio.emit('rooms_update')  # 更新房間列表
+    socketio.emit('state_update', _public_state(room_state), room=room_id)
+    notify_rooms_update()  # 更新房間列表
     
     print(f'房間 {room_id} 播放: {movie} - {episode}')
 
@@ -323,12 +850,14 @@ def handle_play_pause(data):
     room_id = data.get('room', 'default')
     is_playing = data.get('is_playing', False)
     
-    room_state = get_room_state(room_id)
-    room_state['is_playing'] = is_playing
+    room_state = update_room_state(room_id, is_playing=is_playing)
     
-    socketio.emit('play_pause', {'is_playing': is_playing}, room=room_id)
-    socketio.emit('state_update', room_state, room=room_id)
-    socketio.emit('rooms_update')  # 更新房間列表
+    # play_pause 事件已帶有播放狀態與目前播放位置，不再重送完整狀態
+    socketio.emit('play_pause', {
+        'is_playing': is_playing,
+        'current_time': _latest_time(room_id, room_state)
+    }, room=room_id)
+    notify_rooms_update()  # 更新房間列表
     
     print(f'房間 {room_id} 播放狀態: {"播放" if is_playing else "暫停"}')
 
@@ -338,11 +867,11 @@ def handle_seek(data):
     room_id = data.get('room', 'default')
     seek_time = data.get('time', 0)
     
-    room_state = get_room_state(room_id)
-    room_state['current_time'] = seek_time
+    # 跳轉前尚未寫回的播放時間不再覆蓋新位置
+    update_room_state(room_id, current_time=seek_time, time_reset_at=time.time())
     
+    # seek 事件已帶有新時間，不再重送完整狀態
     socketio.emit('seek', {'time': seek_time}, room=room_id)
-    socketio.emit('state_update', room_state, room=room_id)
     
     print(f'房間 {room_id} 跳轉到: {seek_time}秒')
 
@@ -352,11 +881,13 @@ def handle_volume(data):
     room_id = data.get('room', 'default')
     volume = data.get('volume', 1.0)
     
-    room_state = get_room_state(room_id)
-    room_state['volume'] = volume
+    room_state = update_room_state(room_id, volume=volume)
     
-    socketio.emit('volume', {'volume': volume}, room=room_id)
-    socketio.emit('state_update', room_state, room=room_id)
+    # volume 事件已帶有新音量與目前播放位置，不再重送完整狀態
+    socketio.emit('volume', {
+        'volume': volume,
+        'current_time': _latest_time(room_id, room_state)
+    }, room=room_id)
     
     print(f'房間 {room_id} 音量: {volume * 100}%')
 
@@ -371,11 +902,8 @@ def handle_fullscreen(data):
 @socketio.on('time_update')
 def handle_time_update(data):
     """時間更新（來自播放器）"""
-    room_id = data.get('room', 'default')
-    current_time = data.get('time', 0)
-    
-    room_state = get_room_state(room_id)
-    room_state['current_time'] = current_time
+    # 熱路徑只記錄最新值，由 _flush_time_updates 每秒寫回房間狀態
+    _pending_times[data.get('room', 'default')] = (data.get('time', 0), time.time())
     # 只更新狀態，不廣播避免循環
 
 @socketio.on('video_ended')
@@ -383,8 +911,7 @@ def handle_video_ended(data):
     """處理影片播放結束事件"""
     room_id = data.get('room', 'default')
     
-    room_state = get_room_state(room_id)
-    room_state['is_playing'] = False
+    room_state = update_room_state(room_id, is_playing=False)
     
     # 廣播播放結束事件給該房間的控制台
     socketio.emit('video_ended', {
@@ -394,9 +921,8 @@ def handle_video_ended(data):
         'timestamp': data.get('timestamp', time.time())
     }, room=room_id)
     
-    # 更新房間狀態
-    socketio.emit('state_update', room_state, room=room_id)
-    socketio.emit('rooms_update')  # 更新房間列表
+    # 控制台收到 video_ended 後自行標記為暫停，不再重送完整狀態
+    notify_rooms_update()  # 更新房間列表
     
     print(f'房間 {room_id} 影片播放結束: {room_state["current_movie"]} - {room_state["current_episode"]}')
 
@@ -421,6 +947,6 @@ if __name__ == '__main__':
         print(f"    已建立目錄: {DATA_DIR}")
     
     try:
-        socketio.run(app, host='0.0.0.0', port=PORT, debug=False, allow_unsafe_werkzeug=True)
+        socketio.run(app, host='0.0.0.0', port=PORT, debug=False)
     except KeyboardInterrupt:
         print("\n伺服器已停止")